@@ -0,0 +1,382 @@
+"""
+Benchmark the push path of hugging_corenlp.py and hugging_stanza.py offline
+
+A MockHub stands in for HfApi, implementing the calls the push scripts
+make (create_repo, list_models, list_repo_tree, hf_hub_download,
+preupload_lfs_files, create_commit, list_repo_refs, create_tag,
+delete_tag) with a configurable per-call latency and a shared uplink of
+configurable bandwidth.  Synthetic CoreNLP jars and Stanza language
+trees of the requested size are generated in a temporary directory.
+
+Each scenario reports the wall time of the release, the bytes uploaded,
+the throughput, and the number of Hub calls per repo:
+  release   push everything to an empty Hub
+  rerun     push the same files again, which should upload nothing
+  change    rewrite one artifact and push again
+
+python3 bench_push.py --script corenlp --workers 4
+python3 bench_push.py --script stanza --languages 20 --latency_ms 100 --json bench.json
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+from collections import Counter
+from types import SimpleNamespace
+
+from hugging_utils import git_blob_sha1
+
+# files smaller than this are stored as regular git files, larger ones in LFS
+LFS_THRESHOLD = 1024 * 1024
+
+# how much of a file the mock uplink sends at a time
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+class MockHub:
+    """
+    In-process stand-in for the HfApi calls made by the push scripts
+
+    Every call sleeps for latency seconds.  LFS transfers additionally
+    share a single uplink of uplink_mbps megabits per second, so
+    concurrent uploads queue behind each other as they would on a
+    real link, and if stream_mbps is set, no single upload goes faster
+    than that.  Uploads of content the Hub already has are skipped,
+    as the real Hub does
+    """
+    endpoint = "https://mock.huggingface.co"
+
+    def __init__(self, latency=0.05, uplink_mbps=200.0, stream_mbps=None, cache_dir=None):
+        self.latency = latency
+        self.uplink_mbps = uplink_mbps
+        self.stream_mbps = stream_mbps
+        self.cache_dir = cache_dir if cache_dir else tempfile.mkdtemp(prefix="mock_hub_")
+        self.lock = threading.Lock()
+        self.link_lock = threading.Lock()
+        self.link_free_at = 0.0
+        # repo_id -> {"files": {path: entry}, "commits": [sha], "tags": {name: sha}}
+        self.repos = {}
+        self.lfs_objects = set()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = Counter()
+            self.calls_per_repo = Counter()
+            self.bytes_uploaded = 0
+
+    def _call(self, name, repo_id=None):
+        with self.lock:
+            self.calls[name] += 1
+            if repo_id is not None:
+                self.calls_per_repo[repo_id] += 1
+        time.sleep(self.latency)
+
+    def _transfer(self, num_bytes):
+        with self.link_lock:
+            now = time.monotonic()
+            start = max(now, self.link_free_at)
+            self.link_free_at = start + num_bytes * 8 / (self.uplink_mbps * 1000 * 1000)
+            done_at = self.link_free_at
+        if self.stream_mbps:
+            # a single upload can't go faster than stream_mbps
+            done_at = max(done_at, now + num_bytes * 8 / (self.stream_mbps * 1000 * 1000))
+        time.sleep(max(0.0, done_at - time.monotonic()))
+        with self.lock:
+            self.bytes_uploaded += num_bytes
+
+    def _repo(self, repo_id):
+        if repo_id not in self.repos:
+            raise ValueError("Repository Not Found: %s" % repo_id)
+        return self.repos[repo_id]
+
+    def create_repo(self, repo_id, exist_ok=False, **kwargs):
+        self._call("create_repo", repo_id)
+        with self.lock:
+            if repo_id in self.repos and not exist_ok:
+                raise ValueError("Repository already exists: %s" % repo_id)
+            if repo_id not in self.repos:
+                gitattributes = b"*.bin filter=lfs diff=lfs merge=lfs -text\n*.pt filter=lfs diff=lfs merge=lfs -text\n"
+                self.repos[repo_id] = {"files": {".gitattributes": self._entry(".gitattributes", gitattributes)},
+                                       "commits": [self._sha(repo_id)],
+                                       "tags": {}}
+        return "%s/%s" % (self.endpoint, repo_id)
+
+    def list_models(self, author=None, **kwargs):
+        self._call("list_models")
+        return [SimpleNamespace(id=repo_id) for repo_id in sorted(self.repos)
+                if author is None or repo_id.startswith(author + "/")]
+
+    def list_repo_tree(self, repo_id, recursive=False, revision=None, **kwargs):
+        self._call("list_repo_tree", repo_id)
+        repo = self._repo(repo_id)
+        files = repo["files"] if revision is None else repo["snapshots"][self._resolve(repo, revision)]
+        return [SimpleNamespace(path=entry.path, size=entry.size, blob_id=entry.blob_id, lfs=entry.lfs)
+                for entry in files.values()]
+
+    def hf_hub_download(self, repo_id, filename, revision=None, **kwargs):
+        self._call("hf_hub_download", repo_id)
+        entry = self._repo(repo_id)["files"][filename]
+        path = os.path.join(self.cache_dir, repo_id.replace("/", "--"), filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fout:
+            fout.write(entry.content)
+        return path
+
+    def preupload_lfs_files(self, repo_id, additions, **kwargs):
+        self._call("preupload_lfs_files", repo_id)
+        for operation in additions:
+            self._upload(operation)
+
+    def _upload(self, operation):
+        info = operation.upload_info
+        if info.size < LFS_THRESHOLD:
+            return
+        sha256 = info.sha256.hex()
+        with self.lock:
+            if sha256 in self.lfs_objects:
+                return
+        # the contents are read through as_file, as huggingface_hub
+        # does, so that a bandwidth limit on the reads applies here too
+        with operation.as_file() as fileobj:
+            while True:
+                chunk = fileobj.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._transfer(len(chunk))
+        with self.lock:
+            self.lfs_objects.add(sha256)
+
+    def create_commit(self, repo_id, operations, commit_message=None, **kwargs):
+        self._call("create_commit", repo_id)
+        operations = list(operations)
+        for operation in operations:
+            if hasattr(operation, "upload_info"):
+                self._upload(operation)
+        with self.lock:
+            repo = self._repo(repo_id)
+            for operation in operations:
+                if hasattr(operation, "upload_info"):
+                    repo["files"][operation.path_in_repo] = self._operation_entry(operation)
+                else:
+                    repo["files"].pop(operation.path_in_repo, None)
+            sha = self._sha(repo_id, len(repo["commits"]))
+            repo["commits"].append(sha)
+            repo.setdefault("snapshots", {})[sha] = dict(repo["files"])
+        return SimpleNamespace(oid=sha, commit_url="%s/%s/commit/%s" % (self.endpoint, repo_id, sha))
+
+    def list_repo_refs(self, repo_id, **kwargs):
+        self._call("list_repo_refs", repo_id)
+        repo = self._repo(repo_id)
+        branches = [SimpleNamespace(name="main", ref="refs/heads/main", target_commit=repo["commits"][-1])]
+        tags = [SimpleNamespace(name=name, ref="refs/tags/" + name, target_commit=sha) for name, sha in repo["tags"].items()]
+        return SimpleNamespace(branches=branches, tags=tags, converts=[], pull_requests=None)
+
+    def create_tag(self, repo_id, tag, revision=None, **kwargs):
+        self._call("create_tag", repo_id)
+        with self.lock:
+            repo = self._repo(repo_id)
+            if tag in repo["tags"]:
+                raise ValueError("Tag %s already exists in %s" % (tag, repo_id))
+            repo["tags"][tag] = revision if revision else repo["commits"][-1]
+
+    def delete_tag(self, repo_id, tag, **kwargs):
+        self._call("delete_tag", repo_id)
+        with self.lock:
+            del self._repo(repo_id)["tags"][tag]
+
+    def _resolve(self, repo, revision):
+        return repo["tags"].get(revision, revision)
+
+    @staticmethod
+    def _sha(repo_id, index=0):
+        return hashlib.sha1(("%s %d" % (repo_id, index)).encode()).hexdigest()
+
+    @staticmethod
+    def _entry(path, content):
+        if len(content) < LFS_THRESHOLD:
+            return SimpleNamespace(path=path, size=len(content), blob_id=git_blob_sha1(content), lfs=None, content=content)
+        lfs = SimpleNamespace(size=len(content), sha256=hashlib.sha256(content).hexdigest())
+        return SimpleNamespace(path=path, size=len(content), blob_id=None, lfs=lfs, content=None)
+
+    def _operation_entry(self, operation):
+        info = operation.upload_info
+        if info.size >= LFS_THRESHOLD:
+            lfs = SimpleNamespace(size=info.size, sha256=info.sha256.hex())
+            return SimpleNamespace(path=operation.path_in_repo, size=info.size, blob_id=None, lfs=lfs, content=None)
+        with operation.as_file() as fin:
+            content = fin.read()
+        return self._entry(operation.path_in_repo, content)
+
+def write_random_file(path, num_bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fout:
+        remaining = num_bytes
+        while remaining > 0:
+            chunk = min(remaining, 4 * 1024 * 1024)
+            fout.write(os.urandom(chunk))
+            remaining -= chunk
+
+def write_random_archive(path, num_bytes):
+    """
+    Write a valid jar / zip of about num_bytes of random, uncompressed data
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as archive:
+        remaining = num_bytes
+        index = 0
+        while remaining > 0:
+            chunk = min(remaining, 4 * 1024 * 1024)
+            archive.writestr("edu/stanford/nlp/models/part%d.ser" % index, os.urandom(chunk))
+            remaining -= chunk
+            index += 1
+
+def make_corenlp_tree(input_dir, jar_mb, zip_mb):
+    """
+    Write a jar for each of the CoreNLP MODELS, and the CoreNLP zip, to input_dir
+
+    Returns the path of one of the jars, for the change scenario
+    """
+    from hugging_corenlp import MODELS
+    for model in MODELS:
+        size_mb = zip_mb if model.local_name.endswith(".zip") else jar_mb
+        write_random_archive(os.path.join(input_dir, model.local_name), int(size_mb * 1024 * 1024))
+    return os.path.join(input_dir, MODELS[-1].local_name)
+
+def make_stanza_tree(input_dir, version, num_languages, processors, processor_mb):
+    """
+    Write num_languages fake language directories to input_dir + version
+
+    Each language gets processors directories of one .pt file each.
+    The sizes increase from the first language to the last, since
+    real Stanza languages vary a lot in size, and in alphabetical
+    order a large language can easily come last.  Returns the language
+    codes and the path of one .pt file, for the change scenario
+    """
+    languages = ["l%02d" % i for i in range(num_languages)]
+    for lang_idx, lang in enumerate(languages):
+        scale = 0.5 + 1.5 * lang_idx / max(1, num_languages - 1)
+        for processor_idx in range(processors):
+            path = os.path.join(input_dir + version, lang, "processor%d" % processor_idx, "default.pt")
+            write_random_file(path, int(processor_mb * scale * 1024 * 1024))
+    return languages, os.path.join(input_dir + version, languages[-1], "processor0", "default.pt")
+
+def run_scenario(name, push_fn, hub, num_repos, quiet, report_path):
+    hub.reset_stats()
+    start = time.perf_counter()
+    exit_code = 0
+    output = io.StringIO() if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        try:
+            push_fn()
+        except SystemExit as e:
+            exit_code = e.code
+    wall = time.perf_counter() - start
+    makespan = None
+    if os.path.exists(report_path):
+        with open(report_path) as fin:
+            makespan = json.load(fin).get("makespan")
+    result = {
+        "scenario": name,
+        "wall_seconds": round(wall, 3),
+        "bytes_uploaded": hub.bytes_uploaded,
+        "throughput_mbps": round(hub.bytes_uploaded * 8 / wall / 1000 / 1000, 2) if wall > 0 else 0.0,
+        "calls": sum(hub.calls.values()),
+        "calls_per_repo": round(sum(hub.calls.values()) / num_repos, 2),
+        "calls_by_method": dict(hub.calls),
+        "predicted_seconds": makespan["predicted_seconds"] if makespan else None,
+        "makespan_seconds": makespan["actual_seconds"] if makespan else None,
+        "exit_code": exit_code,
+    }
+    return result
+
+def print_results(results):
+    print("%-10s %9s %12s %10s %7s %10s" % ("scenario", "wall (s)", "uploaded", "Mbps", "calls", "calls/repo"))
+    for result in results:
+        print("%-10s %9.2f %10.1f MB %10.1f %7d %10.2f" % (result["scenario"], result["wall_seconds"],
+                                                           result["bytes_uploaded"] / 1024 / 1024,
+                                                           result["throughput_mbps"], result["calls"],
+                                                           result["calls_per_repo"]))
+        methods = ", ".join("%s=%d" % x for x in sorted(result["calls_by_method"].items()))
+        print("           %s" % methods)
+        if result["predicted_seconds"] is not None:
+            print("           makespan %.2fs, predicted %.2fs" % (result["makespan_seconds"], result["predicted_seconds"]))
+        if result["exit_code"]:
+            print("           FAILED with exit code %s" % result["exit_code"])
+
+def parse_args():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--script', choices=['corenlp', 'stanza'], default='corenlp', help='Which push script to benchmark')
+    parser.add_argument('--latency_ms', type=float, default=50.0, help='Latency added to every Hub call')
+    parser.add_argument('--uplink_mbps', type=float, default=200.0, help='Bandwidth of the uplink shared by all uploads')
+    parser.add_argument('--stream_mbps', type=float, default=50.0, help='Fastest a single upload can go, as a single connection rarely fills the uplink.  0 for no limit')
+    parser.add_argument('--jar_mb', type=float, default=4.0, help='Size of each synthetic CoreNLP jar')
+    parser.add_argument('--zip_mb', type=float, default=20.0, help='Size of the synthetic CoreNLP zip')
+    parser.add_argument('--languages', type=int, default=10, help='Number of synthetic Stanza languages')
+    parser.add_argument('--processors', type=int, default=4, help='Number of processors in each synthetic Stanza language')
+    parser.add_argument('--processor_mb', type=float, default=2.0, help='Average size of each synthetic Stanza processor')
+    parser.add_argument('--scenarios', type=str, default='release,rerun,change', help='Comma separated list of scenarios to run')
+    parser.add_argument('--json', type=str, default=None, help='Also write the results to this json file')
+    parser.add_argument('--verbose', action='store_true', default=False, help='Show the output of the push scripts')
+    args, push_args = parser.parse_known_args()
+    # anything not recognized here, such as --workers, goes to the push script
+    args.push_args = push_args
+    return args
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix="bench_push_")
+    try:
+        hub = MockHub(latency=args.latency_ms / 1000, uplink_mbps=args.uplink_mbps, stream_mbps=args.stream_mbps,
+                      cache_dir=os.path.join(work_dir, "hub_cache"))
+        output_dir = os.path.join(work_dir, "output")
+        report_path = os.path.join(work_dir, "report.json")
+        # the push scripts predict the makespan with the bandwidth of the mock uplink
+        common_args = ["--output_dir", output_dir, "--report", report_path, "--bandwidth_mbps", str(args.uplink_mbps)]
+        if args.script == 'corenlp':
+            import hugging_corenlp
+            input_dir = os.path.join(work_dir, "corenlp")
+            changed_path = make_corenlp_tree(input_dir, args.jar_mb, args.zip_mb)
+            num_repos = len(hugging_corenlp.MODELS)
+            push_args = ["--input_dir", input_dir] + common_args + args.push_args
+            push_fn = lambda: hugging_corenlp.push_to_hub(push_args, api=hub)
+        else:
+            import hugging_stanza
+            input_dir = os.path.join(work_dir, "stanza")
+            version = "0.0.1"
+            languages, changed_path = make_stanza_tree(input_dir, version, args.languages, args.processors, args.processor_mb)
+            num_repos = len(languages)
+            push_args = ["--input_dir", input_dir, "--version", version] + common_args + args.push_args + languages
+            push_fn = lambda: hugging_stanza.push_to_hub(push_args, api=hub)
+
+        results = []
+        for scenario in args.scenarios.split(","):
+            if scenario == 'change':
+                if args.script == 'corenlp':
+                    write_random_archive(changed_path, os.path.getsize(changed_path))
+                else:
+                    write_random_file(changed_path, os.path.getsize(changed_path))
+            elif scenario not in ('release', 'rerun'):
+                raise ValueError("Unknown scenario %s" % scenario)
+            if os.path.exists(report_path):
+                os.remove(report_path)
+            results.append(run_scenario(scenario, push_fn, hub, num_repos, quiet=not args.verbose, report_path=report_path))
+
+        print_results(results)
+        if args.json:
+            with open(args.json, "w") as fout:
+                json.dump({"args": {k: v for k, v in vars(args).items()}, "results": results}, fout, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
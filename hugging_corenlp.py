@@ -5,19 +5,29 @@ Generously provided by Omar Sanseviero
 
 huggingface-cli login
 python3 hugging_corenlp.py --input_dir <models_path>  --branch <version>
+
+The options for pushing several repos at once, limiting the upload
+bandwidth, planning and resuming a run are shared with hugging_stanza.py
+and described in hugging_utils.py
 """
 
 import argparse
-import datetime
 import os
-import shutil
+import sys
+import zipfile
 
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from huggingface_hub import  HfApi, HfFolder
 
-from huggingface_hub import  HfApi, HfFolder, hf_hub_download
+from hugging_utils import HashCache, HttpPool, Journal, PushContext, PushResult, RunReport, Scheduler, add_push_args, commit_files, ensure_repo, finish_run, get_remote_manifest, get_repo_url, list_existing_repos, load_remote_manifest, plan_error, plan_repo, prefetch_hashes, print_plan, run_largest_first, tag_version
 
-def get_model_card(lang, model):
-    now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+def get_model_card(lang, model, version, filename, sha256):
+    """
+    The card only depends on the model, the version and the contents of the
+    model file, so a repo which didn't change gets the same card every time
+    """
     model_card = """---
 tags:
 - corenlp
@@ -31,8 +41,8 @@ Find more about it in [our website](https://stanfordnlp.github.io/CoreNLP) and o
 
 This card and repo were automatically prepared with `hugging_corenlp.py` in the `stanfordnlp/huggingface-models` repo
 
-Last updated {now}
-""".format(lang=lang, model=model, now=now)
+Model version {version}.  sha256 of {filename}: {sha256}
+""".format(lang=lang, model=model, version=version, filename=filename, sha256=sha256)
     return model_card
 
 # lang is an abbrev to use in the model card
@@ -55,112 +65,266 @@ MODELS = [
     Model("spanish",          "es",   "stanford-spanish-corenlp-models-current.jar",     None,                          None),
 ]
 
-def write_model_card(repo_local_path, lang, model):
-    """
-    Write a README for the current model to the given path
-    """
-    readme_path = os.path.join(repo_local_path, "README.md")
-    with open(readme_path, "w") as f:
-        f.write(get_model_card(lang, model))
-
-def parse_args():
+def parse_args(args=None):
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     # "/home/john/extern_data/corenlp/"
     parser.add_argument('--input_dir', type=str, default="/u/nlp/data/StanfordCoreNLPModels", help='Directory for loading the CoreNLP models')
     # "/home/john/huggingface/hub"
-    parser.add_argument('--output_dir', type=str, default="/u/nlp/software/hub", help='Directory with the repos')
+    parser.add_argument('--output_dir', type=str, default="/u/nlp/software/hub", help='Directory for the hash cache and other bookkeeping')
     parser.add_argument('--version', type=str, default="4.5.8", help='Version of corenlp models to upload')
     parser.add_argument('--no_models', dest="models", action='store_false', default=True, help="Only push the package without updating the models.  Useful for when a new version is released, with only code changes, and the 'latest' symlink wasn't properly updated")
-    args = parser.parse_args()
+    add_push_args(parser)
+    args = parser.parse_args(args)
     return args
 
 
-def maybe_add_lfs(api, repo_id, repo_local_path, extension):
-    # read the existing .gitattributes file
-    git_filename = os.path.join(repo_local_path, ".gitattributes")
-    with open(git_filename) as fin:
-        lines = fin.readlines()
+# file patterns which need to be stored in LFS in every repo
+LFS_PATTERNS = ('*.jar', '*.zip')
 
-    # if the extension isn't already there, add it and push the new version
-    if not any(line.startswith(extension + " ") for line in lines):
+def maybe_add_lfs(gitattributes, extensions):
+    """
+    Add any of extensions which aren't tracked by LFS yet to gitattributes
+
+    gitattributes is the bytes of the current .gitattributes, and the
+    bytes of the updated file are returned.  All of the extensions are
+    handled at once, so there is at most one change to push
+    """
+    lines = gitattributes.decode().splitlines(keepends=True)
+    missing = [extension for extension in extensions
+               if not any(line.startswith(extension + " ") for line in lines)]
+    if not missing:
+        return gitattributes
+
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] = lines[-1] + "\n"
+    for extension in missing:
         lines.append("%s filter=lfs diff=lfs merge=lfs -text\n" % extension)
-        blob = "".join(lines).encode()
-        api.upload_file(repo_id=repo_id, path_in_repo=".gitattributes", path_or_fileobj=blob)
+    return "".join(lines).encode()
+
+def read_gitattributes(api, repo_id, remote_manifest):
+    """
+    Return the bytes of the repo's current .gitattributes, or b"" if it has none
+
+    The file goes through the regular Hub cache, so it is only downloaded
+    again when it changes
+    """
+    if ".gitattributes" not in remote_manifest:
+        return b""
+    path = api.hf_hub_download(repo_id, ".gitattributes")
+    with open(path, "rb") as fin:
+        return fin.read()
+
+def get_repo_name(model):
+    return model.repo_name if model.repo_name else "corenlp-%s" % model.model_name
+
+def get_remote_name(model):
+    return model.remote_name if model.remote_name else f"stanford-corenlp-models-{model.model_name}.jar"
+
+def find_model_file(input_dir, version, model):
+    """
+    Return the path to the local jar / zip for the given Model
+    """
+    model_name = model.model_name
+    src_candidates = [f"stanford-corenlp-models-{model_name}.jar",
+                      model.local_name,
+                      # stanford-corenlp-4.4.0-models-arabic.jar
+                      f"stanford-corenlp-{version}-models-{model_name}.jar"]
+    for src in src_candidates:
+        if input_dir:
+            src = os.path.join(input_dir, src)
+        if os.path.exists(src):
+            return src
+    if input_dir:
+        locations_searched = ", ".join(os.path.join(input_dir, src) for src in src_candidates)
+    else:
+        locations_searched = ", ".join(src_candidates)
+    raise FileNotFoundError(f"Cannot find {model_name} model.  Looked in {locations_searched}")
+
+def check_archive(path):
+    """
+    Check that the jar / zip at path is complete, without decompressing it
+
+    Only the end of central directory record and the central directory
+    are read.  A truncated copy loses the end of central directory, and
+    an entry whose data would run into the central directory means the
+    archive was cut short and patched up.  Returns None if the archive
+    looks fine, or a description of the problem
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            entries = archive.infolist()
+            central_directory_start = archive.start_dir
+    except (zipfile.BadZipFile, OSError) as e:
+        return f"{path} is not a complete archive: {e}"
+    if not entries:
+        return f"{path} is an empty archive"
+    for entry in entries:
+        # 30 bytes of local header, then the name, then the data
+        data_end = entry.header_offset + 30 + len(entry.orig_filename.encode()) + entry.compress_size
+        if data_end > central_directory_start:
+            return f"{path} is truncated: {entry.filename} runs past the start of the central directory"
+    return None
+
+def check_models(args, models):
+    """
+    Find and check the archive of each of models, in parallel
+
+    Returns a map from each Model to (path, error), where error is None
+    if the archive was found and is complete
+    """
+    def check_one(model):
+        try:
+            src = find_model_file(args.input_dir, args.version, model)
+        except FileNotFoundError as e:
+            return None, e
+        error = check_archive(src)
+        return src, (ValueError(error) if error else None)
 
-def push_to_hub():
-    args = parse_args()
-    api = HfApi()
+    with ThreadPoolExecutor(max_workers=max(1, min(len(models), args.hash_workers))) as executor:
+        return dict(zip(models, executor.map(check_one, models)))
+
+def get_local_files(model, src, version, hash_file):
+    """
+    Return the map from path in repo to local file or bytes for the model and its card
+    """
+    remote_name = get_remote_name(model)
+    model_card = get_model_card(model.lang, model.model_name, version, remote_name, hash_file(src))
+    return {
+        remote_name: src,
+        "README.md": model_card.encode(),
+    }
+
+def plan_model(hash_cache, args, model, src, error, hash_file=None):
+    """
+    Describe what push_model would do, using only local files and the cached remote manifest
+
+    By default the model is hashed if it isn't in the hash cache.  With
+    hash_file=hash_cache.lookup, only the cached hash is used, and a
+    model which isn't cached counts as changed
+    """
+    repo_id = "stanfordnlp/" + get_repo_name(model)
+    if error is not None:
+        return plan_error(repo_id, error)
+    if hash_file is None:
+        hash_file = hash_cache.sha256
+    remote_manifest = load_remote_manifest(args.output_dir, repo_id)
+    return plan_repo(repo_id, get_local_files(model, src, args.version, hash_file), remote_manifest, hash_file=hash_file)
+
+def hash_model(ctx, model, src):
+    """
+    Start hashing the model file ahead of push_model, which then finds the hash in the cache
+    """
+    repo_id = "stanfordnlp/" + get_repo_name(model)
+    if ctx.journal.get(repo_id, "commit"):
+        return None
+    return prefetch_hashes(ctx, repo_id, [src])
+
+def push_model(ctx, args, model):
+    """
+    Push a single Model to its repo, returning the url of the repo
+    """
+    repo_id = "stanfordnlp/" + get_repo_name(model)
+    if ctx.journal.get(repo_id, "tag"):
+        print(f"{repo_id} was already pushed and tagged, skipping")
+        return get_repo_url(ctx.api, repo_id)
+
+    # Create the repository
+    with ctx.scheduler.metadata(), ctx.report.phase(repo_id, "ensure_repo"):
+        repo_url = ensure_repo(ctx.api, repo_id, ctx.existing_repos)
+    if not ctx.journal.get(repo_id, "repo"):
+        ctx.journal.record(repo_id, "repo")
+
+    commit_record = ctx.journal.get(repo_id, "commit")
+    if commit_record:
+        commit = commit_record["commit"]
+        print(f"Files were already committed to {repo_id}, skipping to the tag")
+    else:
+        # The jar / zip is uploaded straight from input_dir and the
+        # model card and .gitattributes from memory, so nothing is staged
+        src = find_model_file(args.input_dir, args.version, model)
+        print(f"Using model from {src}")
+
+        # only the files which differ from what is already on the Hub are sent
+        with ctx.scheduler.metadata():
+            with ctx.report.phase(repo_id, "manifest"):
+                remote_manifest = get_remote_manifest(ctx.api, repo_id)
+            # check the lfs status of .zip and .jar
+            with ctx.report.phase(repo_id, "gitattributes"):
+                gitattributes = read_gitattributes(ctx.api, repo_id, remote_manifest)
+
+        # .gitattributes, the model, and the model card all go in one
+        # commit, and any of them which are unchanged are left out
+        with ctx.report.phase(repo_id, "model_card"):
+            local_files = get_local_files(model, src, args.version, ctx.hash_cache.sha256)
+        local_files[".gitattributes"] = maybe_add_lfs(gitattributes, LFS_PATTERNS)
+        commit = commit_files(ctx, args, repo_id, local_files, remote_manifest)
+
+    tag_version(ctx, args, repo_id, commit)
+
+    print(f"View your model in {repo_url}")
+    return repo_url
+
+def push_to_hub(args=None, api=None):
+    """
+    Push the models described by the command line args
+
+    api can be replaced with a stand-in for the Hub, as in bench_push.py
+    """
+    args = parse_args(args)
+    hash_cache = HashCache.from_args(args)
 
-    input_dir = args.input_dir
     if args.models:
         stuff_to_push = MODELS
     else:
         stuff_to_push = [x for x in MODELS if x.model_name == 'CoreNLP']
 
-    for model in stuff_to_push:
-        # Create the repository
-        lang = model.lang
-        model_name = model.model_name
-        repo_name = model.repo_name if model.repo_name else "corenlp-%s" % model_name
-        repo_id = "stanfordnlp/" + repo_name
-        repo_url = api.create_repo(
-            repo_id=repo_id,
-            exist_ok=True,
-        )
-
-        # check the lfs status of .zip and .jar
-        # TODO: we can probably get rid of repo_local_path
-        # - use a temporary file for .gitattributes
-        # - use a bytes blob for the README
-        # - use the jar / zip file for CoreNLP directly, wherever it is
-        repo_local_path = os.path.join(args.output_dir, repo_name)
-        hf_hub_download(repo_id, ".gitattributes", local_dir=repo_local_path, local_dir_use_symlinks=False)
-        maybe_add_lfs(api, repo_id, repo_local_path, '*.jar')
-        maybe_add_lfs(api, repo_id, repo_local_path, '*.zip')
-
-        # Create a copy of the jar file in the repository
-        dst = os.path.join(repo_local_path, model.remote_name) if model.remote_name else os.path.join(repo_local_path, f"stanford-corenlp-models-{model_name}.jar")
-        src_candidates = [f"stanford-corenlp-models-{model_name}.jar",
-                          model.local_name,
-                          # stanford-corenlp-4.4.0-models-arabic.jar
-                          f"stanford-corenlp-{args.version}-models-{model_name}.jar"]
-        for src in src_candidates:
-            if input_dir:
-                src = os.path.join(input_dir, src)
-            if os.path.exists(src):
-                break
-        else:
-            if input_dir:
-                locations_searched = ", ".join(os.path.join(input_dir, src) for src in src_candidates)
-            else:
-                locations_searched = ", ".join(src_candidates)
-            raise FileNotFoundError(f"Cannot find {model_name} model.  Looked in {locations_searched}")
-        print(f"Copying model from {src} to {dst}")
-        shutil.copy(src, dst)
-
-        # Create the model card
-        write_model_card(repo_local_path, lang, model_name)
-
-        # Upload model + model card
-        # setting delete_patterns will clean up old model files as we go
-        # note: the error of not having anything to push will hopefully
-        # never happen since the README is updated to the millisecond
-        print("Pushing files to the Hub from %s to %s" % (repo_local_path, repo_id))
-        api.upload_folder(repo_id=repo_id, folder_path=repo_local_path, commit_message=f"Add model {args.version}")
-
-        # Check and delete tag if already exist
-        new_tag_name = "v" + args.version
-        refs = api.list_repo_refs(repo_id=repo_id)
-        for tag in refs.tags:
-            if tag.name == new_tag_name:
-                api.delete_tag(repo_id=repo_id, tag=new_tag_name)
-                break
-
-        # Tag model version
-        api.create_tag(repo_id=repo_id, tag=new_tag_name, tag_message=f"Adding new version of models {new_tag_name}")
-        print(f"Added a tag for the new models: {new_tag_name}")
-
-        print(f"View your model in {repo_url}")
+    # every archive is checked before anything is pushed, so a missing
+    # or truncated model is caught in milliseconds rather than after
+    # minutes of uploading
+    checked = check_models(args, stuff_to_push)
+    invalid = [model for model in stuff_to_push if checked[model][1] is not None]
+    for model in invalid:
+        print("Not pushing %s: %s" % (model.model_name, checked[model][1]))
+
+    if args.plan:
+        # hash all of the models at once, so the process pool works on them in parallel
+        hash_cache.hash_files([src for model, (src, error) in checked.items() if error is None])
+        entries = [plan_model(hash_cache, args, model, *checked[model]) for model in stuff_to_push]
+        hash_cache.close()
+        if print_plan(entries, args.bandwidth_mbps) > 0:
+            sys.exit(1)
+        return
+
+    # every Hub call in the run goes through one pool of connections
+    http_pool = None
+    if api is None:
+        http_pool = HttpPool.from_args(args)
+        http_pool.install()
+        api = HfApi()
+    # only repos which aren't already on the Hub need a create_repo call
+    ctx = PushContext(api=api,
+                      scheduler=Scheduler.from_args(args),
+                      hash_cache=hash_cache,
+                      existing_repos=list_existing_repos(api),
+                      journal=Journal.from_args(args, "corenlp"),
+                      report=RunReport())
+
+    valid = [model for model in stuff_to_push if model not in invalid]
+
+    # each Model is pushed independently, so a failure in one repo
+    # doesn't stop the others.  the summary at the end lists any failures
+    # the models with the most to upload, such as the CoreNLP zip,
+    # are started first so they don't hold up the end of the release.
+    # they are sized with only the hashes already in the cache, and
+    # the next models are hashed while the current ones upload
+    describe = lambda model: "stanfordnlp/" + get_repo_name(model)
+    results = run_largest_first(ctx, args, valid,
+                                lambda model: plan_model(hash_cache, args, model, *checked[model], hash_file=hash_cache.lookup),
+                                lambda model: push_model(ctx, args, model),
+                                describe=describe,
+                                prepare_fn=lambda model: hash_model(ctx, model, checked[model][0]))
+    results.extend(PushResult(describe(model), None, checked[model][1]) for model in invalid)
+    finish_run(ctx, args, results, http_pool, "corenlp")
 
 
 if __name__ == '__main__':
@@ -5,21 +5,80 @@ Generously provided by Omar Sanseviero
 
 huggingface-cli login
 python hugging_stanza.py --input_dir <models_path>  --version <version>
+
+The options for pushing several languages at once, limiting the upload
+bandwidth, planning and resuming a run are shared with hugging_corenlp.py
+and described in hugging_utils.py
+
+Languages whose models are the same as at the previous version tag
+are not uploaded again, only tagged.  Use --force to push them anyway
+
+Use --max_commit_mb and --max_commit_files to commit large languages
+in several parts.  If a push fails partway through, rerunning it only
+sends the parts which aren't on the Hub yet
+
+The model cards are built in memory, so input_dir is only read and
+can be a read-only or snapshot mount
 """
 
 import argparse
-import datetime
+import functools
+import json
 import os
 import shutil
+import sys
+from importlib import metadata
 from pathlib import Path
 
-from stanza.resources.common import list_available_languages
-from stanza.models.common.constant import lcode2lang, lang2lcode
-
 from huggingface_hub import HfApi
 
-def get_model_card(lang):
-    now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+from hugging_utils import HashCache, HttpPool, Journal, PushContext, RunReport, Scheduler, add_push_args, commit_files, content_digest, ensure_repo, finish_run, find_changes, find_previous_version_tag, get_remote_manifest, get_repo_url, list_existing_repos, list_local_files, load_remote_manifest, plan_error, plan_repo, prefetch_hashes, print_plan, run_largest_first, tag_version
+
+@functools.lru_cache(maxsize=None)
+def get_language_names(output_dir):
+    """
+    Return the lcode2lang and lang2lcode tables from stanza
+
+    Importing stanza pulls in torch and takes seconds, so the tables are
+    cached in output_dir and only reloaded from stanza when the installed
+    version of stanza changes.  If stanza isn't installed, the cached
+    tables are used, or empty tables if there is no cache, in which case
+    the model cards just use the language codes
+    """
+    cache_path = os.path.join(output_dir, "stanza_languages.json")
+    try:
+        stanza_version = metadata.version("stanza")
+    except metadata.PackageNotFoundError:
+        stanza_version = None
+
+    cached = None
+    if os.path.exists(cache_path):
+        with open(cache_path) as fin:
+            cached = json.load(fin)
+        if stanza_version is None or cached["stanza_version"] == stanza_version:
+            return cached["lcode2lang"], cached["lang2lcode"]
+
+    if stanza_version is None:
+        print("Stanza is not installed and there is no cached language table in %s.  Model cards will only use language codes" % output_dir)
+        return {}, {}
+
+    from stanza.models.common.constant import lcode2lang, lang2lcode
+    tables = {"stanza_version": stanza_version, "lcode2lang": dict(lcode2lang), "lang2lcode": dict(lang2lcode)}
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(cache_path + ".tmp", "w") as fout:
+            json.dump(tables, fout, indent=2, sort_keys=True)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError as e:
+        print("Could not cache the stanza language table in %s: %s" % (cache_path, e))
+    return tables["lcode2lang"], tables["lang2lcode"]
+
+def get_model_card(lang, language_names, version, digest):
+    """
+    The card only depends on the language, the version and the digest of
+    the model files, so a repo which didn't change gets the same card every time
+    """
+    lcode2lang, lang2lcode = language_names
     full_lang = lcode2lang.get(lang, None)
     short_lang = lang2lcode.get(lang, lang)
     short_lang = short_lang.split("-")[0]
@@ -38,70 +97,266 @@ Find more about it in [our website](https://stanfordnlp.github.io/stanza) and ou
 
 This card and repo were automatically prepared with `hugging_stanza.py` in the `stanfordnlp/huggingface-models` repo
 
-Last updated {now}
-""".format(short_lang=short_lang, lang_text=lang_text, now=now)
+Model version {version}.  Digest of the model files: {digest}
+""".format(short_lang=short_lang, lang_text=lang_text, version=version, digest=digest)
     return model_card
 
-def parse_args():
+def build_model_card(args, model, model_files, hash_file):
+    """
+    Return the bytes of the model card for the model files in model_files
+    """
+    digest = content_digest(model_files, hash_file)
+    return get_model_card(model, get_language_names(args.output_dir), args.version, digest).encode()
+
+def parse_args(args=None):
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--input_dir', type=str, default="/u/nlp/software/stanza/models/", help='Directory for loading the stanza models.  Will first try input_dir + version, if that exists')
+    parser.add_argument('--output_dir', type=str, default="/u/nlp/software/hub", help='Directory for the hash cache and other bookkeeping')
     parser.add_argument('--version', type=str, default="1.10.0", help='Version of stanza models to upload')
-    parser.add_argument('lang', nargs='*', help='List of languages.  Will default to all languages')
-    args = parser.parse_args()
-    if len(args.lang) == 0:
-        # TODO: use version to get the available languages
-        # TODO: skip languages where the version and the data didn't change
-        args.lang = list_available_languages()
+    parser.add_argument('--force', action='store_true', default=False, help='Push every language, even the ones whose models are unchanged since the previous version tag')
+    parser.add_argument('--max_commit_mb', type=float, default=None, help='Split the changes of a language into commits of at most this many MB.  By default each language is one commit')
+    parser.add_argument('--max_commit_files', type=int, default=None, help='Split the changes of a language into commits of at most this many files.  Deleted files count towards the limit')
+    parser.add_argument('lang', nargs='*', help='List of languages.  Will default to all of the languages with models in input_dir')
+    add_push_args(parser)
+    args = parser.parse_args(args)
+    # if no languages were given, push_to_hub discovers them from
+    # the models for this version in input_dir
     return args
 
-def push_to_hub():
-    args = parse_args()
+def discover_languages(input_dir, version):
+    """
+    Return the languages which have models in input_dir
+
+    If input_dir has a resources_<version>.json or resources.json, the
+    languages come from that, keeping only the ones with a directory
+    of models.  Otherwise, every non-hidden subdirectory with at least
+    one file in it is treated as a language.  Either way, the languages
+    match the models on disk rather than the installed version of stanza
+    """
+    for resources_name in ("resources_%s.json" % version, "resources.json"):
+        resources_path = os.path.join(input_dir, resources_name)
+        if os.path.exists(resources_path):
+            break
+    else:
+        resources_path = None
+
+    if resources_path:
+        with open(resources_path) as fin:
+            resources = json.load(fin)
+        # aliases such as "chinese" -> "zh-hans" don't have models of their own
+        listed = sorted(lang for lang, entry in resources.items()
+                        if isinstance(entry, dict) and "alias" not in entry)
+        languages = [lang for lang in listed if os.path.isdir(os.path.join(input_dir, lang))]
+        missing = sorted(set(listed) - set(languages))
+        if missing:
+            print("Languages in %s with no models in %s: %s" % (resources_path, input_dir, missing))
+        print("Found %d languages in %s" % (len(languages), resources_path))
+        return languages
+
+    languages = []
+    for entry in sorted(os.scandir(input_dir), key=lambda x: x.name):
+        if entry.name.startswith(".") or not entry.is_dir():
+            continue
+        if any(files for _, _, files in os.walk(entry.path)):
+            languages.append(entry.name)
+    print("Found %d language directories in %s" % (len(languages), input_dir))
+    return languages
+
+def resolve_input_dir(args):
+    """
+    Use input_dir + version if that exists, otherwise input_dir
+    """
     input_dir = args.input_dir
     if os.path.exists(input_dir + args.version):
         input_dir = input_dir + args.version
         print("Found directory in %s - using that instead of %s" % (input_dir, args.input_dir))
+    return input_dir
 
-    new_tag_name = "v" + args.version
+def list_model_files(src):
+    """
+    Return the map from path in repo to local path of the model files of a language
 
-    api = HfApi()
+    The model card is built in memory and never written to the model
+    tree, so a README.md left in the tree by an older version of this
+    script is ignored
+    """
+    local_files = list_local_files(src)
+    local_files.pop("README.md", None)
+    return local_files
 
-    print("Processing languages: {}".format(args.lang))
-    for model in args.lang:
-        print(f"Processing {model}")
-        # Create the repository
-        repo_name = "stanza-" + model
-        repo_id = "stanfordnlp/" + repo_name
-        repo_url = api.create_repo(
-            repo_id=repo_id,
-            exist_ok=True
-        )
+def find_language_dir(input_dir, model):
+    src = Path(input_dir) / model
+    if not src.exists():
+        if not input_dir:
+            raise FileNotFoundError(f"Could not find models under {src}.  Perhaps you forgot to set --input_dir?")
+        else:
+            raise FileNotFoundError(f"Could not find models under {src}")
+    return src
 
+def get_repo_id(model):
+    return "stanfordnlp/stanza-" + model
+
+def plan_language(hash_cache, args, input_dir, model, hash_file=None):
+    """
+    Describe what push_language would do, using only local files and the cached remote manifest
+
+    By default the files which aren't in the hash cache are hashed.
+    With hash_file=hash_cache.lookup, only the cached hashes are used,
+    and files which aren't cached count as changed
+    """
+    repo_id = get_repo_id(model)
+    try:
+        src = find_language_dir(input_dir, model)
+    except FileNotFoundError as e:
+        return plan_error(repo_id, e)
+    local_files = list_model_files(src)
+    if hash_file is None:
+        hash_cache.hash_files(local_files.values())
+        hash_file = hash_cache.sha256
+    local_files["README.md"] = build_model_card(args, model, local_files, hash_file)
+    remote_manifest = load_remote_manifest(args.output_dir, repo_id)
+    return plan_repo(repo_id, local_files, remote_manifest, delete_patterns="*.pt", hash_file=hash_file)
+
+def hash_language(ctx, input_dir, model):
+    """
+    Start hashing the model files of a language ahead of push_language, which then finds the hashes in the cache
+    """
+    repo_id = get_repo_id(model)
+    if ctx.journal.get(repo_id, "commit"):
+        return None
+    local_paths = list(list_model_files(find_language_dir(input_dir, model)).values())
+    return prefetch_hashes(ctx, repo_id, local_paths)
+
+def find_unchanged_tag(ctx, args, repo_id, model_files):
+    """
+    Check if model_files match the files of the previous version tag of repo_id
+
+    The model card is left out of the comparison, since it changes
+    with every version.  Returns the previous tag, or None if there
+    isn't one or the models changed, along with the refs of the repo
+    """
+    with ctx.scheduler.metadata(), ctx.report.phase(repo_id, "previous_tag"):
+        refs = ctx.api.list_repo_refs(repo_id=repo_id)
+        previous_tag = find_previous_version_tag(refs, "v" + args.version)
+        if previous_tag is None:
+            return None, refs
+        previous_manifest = get_remote_manifest(ctx.api, repo_id, revision=previous_tag.name)
+    previous_manifest.pop("README.md", None)
+    with ctx.report.phase(repo_id, "compare"):
+        changed, deleted = find_changes(model_files, previous_manifest, delete_patterns="*.pt", hash_file=ctx.hash_cache.sha256)
+    if changed or deleted:
+        return None, refs
+    return previous_tag, refs
+
+def push_language(ctx, args, input_dir, model):
+    """
+    Push the models for one language to its repo, returning the url of the repo
+    """
+    print(f"Processing {model}")
+    repo_id = get_repo_id(model)
+    if ctx.journal.get(repo_id, "tag"):
+        print(f"{repo_id} was already pushed and tagged, skipping")
+        return get_repo_url(ctx.api, repo_id)
+
+    # Create the repository
+    with ctx.scheduler.metadata(), ctx.report.phase(repo_id, "ensure_repo"):
+        repo_url = ensure_repo(ctx.api, repo_id, ctx.existing_repos)
+    if not ctx.journal.get(repo_id, "repo"):
+        ctx.journal.record(repo_id, "repo")
+
+    refs = None
+    commit_record = ctx.journal.get(repo_id, "commit")
+    if commit_record:
+        commit = commit_record["commit"]
+        print(f"Files were already committed to {repo_id}, skipping to the tag")
+    else:
         # Find src folder
-        src = Path(input_dir) / model
-        if not src.exists():
-            if not input_dir:
-                raise FileNotFoundError(f"Could not find models under {src}.  Perhaps you forgot to set --input_dir?")
-            else:
-                raise FileNotFoundError(f"Could not find models under {src}")
-
-        # Update model card in it
-        (src / "README.md").write_text(get_model_card(model))
-
-        # Upload model + model card
-        # setting delete_patterns will clean up old model files as we go
-        api.upload_folder(repo_id=repo_id, folder_path=src, commit_message=f"Add model {args.version}", delete_patterns="*.pt")
-
-        # Check and delete tag if already exist
-        refs = api.list_repo_refs(repo_id=repo_id)
-        for tag in refs.tags:
-            if tag.name == new_tag_name:
-                api.delete_tag(repo_id=repo_id, tag=new_tag_name)
-                break
-
-        # Tag model version
-        api.create_tag(repo_id=repo_id, tag=new_tag_name, tag_message=f"Adding new version of models {new_tag_name}")
-        print(f"Added a tag for the new models: {new_tag_name}")
-        print(f"View your model in:\n  {repo_url}\n\n")
+        # the model files were already hashed by hash_language, so the
+        # comparisons and the model card below use the cache
+        src = find_language_dir(input_dir, model)
+        model_files = list_model_files(src)
+
+        # If the models are the same as in the previous version, the
+        # new version tag goes on the previous version's commit and
+        # nothing is uploaded
+        previous_tag = None
+        if not args.force:
+            previous_tag, refs = find_unchanged_tag(ctx, args, repo_id, model_files)
+        if previous_tag is not None:
+            commit = previous_tag.target_commit
+            print(f"Models for {model} are unchanged since {previous_tag.name}, only tagging")
+            ctx.journal.record(repo_id, "commit", commit=commit, unchanged_since=previous_tag.name)
+        else:
+            # The model card goes in the commit straight from memory,
+            # so the model tree is only ever read
+            local_files = dict(model_files)
+            with ctx.report.phase(repo_id, "model_card"):
+                local_files["README.md"] = build_model_card(args, model, model_files, ctx.hash_cache.sha256)
+
+            # Upload model + model card
+            # only the files which differ from what is already on the Hub are sent
+            # setting delete_patterns will clean up old model files as we go
+            with ctx.scheduler.metadata(), ctx.report.phase(repo_id, "manifest"):
+                remote_manifest = get_remote_manifest(ctx.api, repo_id)
+            # with --max_commit_mb or --max_commit_files, a large language
+            # is committed in parts, and a failure only loses the last part
+            max_bytes = int(args.max_commit_mb * 1024 * 1024) if args.max_commit_mb else None
+            commit = commit_files(ctx, args, repo_id, local_files, remote_manifest, delete_patterns="*.pt",
+                                  max_bytes=max_bytes, max_files=args.max_commit_files)
+            if commit is not None:
+                # the new commit makes the refs out of date
+                refs = None
+
+    tag_version(ctx, args, repo_id, commit, refs)
+    print(f"View your model in:\n  {repo_url}\n\n")
+    return repo_url
+
+def push_to_hub(args=None, api=None):
+    """
+    Push the models described by the command line args
+
+    api can be replaced with a stand-in for the Hub, as in bench_push.py
+    """
+    args = parse_args(args)
+    input_dir = resolve_input_dir(args)
+    if len(args.lang) == 0:
+        args.lang = discover_languages(input_dir, args.version)
+    hash_cache = HashCache.from_args(args)
+
+    if args.plan:
+        entries = [plan_language(hash_cache, args, input_dir, model) for model in args.lang]
+        hash_cache.close()
+        if print_plan(entries, args.bandwidth_mbps) > 0:
+            sys.exit(1)
+        return
+
+    # every Hub call in the run goes through one pool of connections
+    http_pool = None
+    if api is None:
+        http_pool = HttpPool.from_args(args)
+        http_pool.install()
+        api = HfApi()
+    # only repos which aren't already on the Hub need a create_repo call
+    ctx = PushContext(api=api,
+                      scheduler=Scheduler.from_args(args),
+                      hash_cache=hash_cache,
+                      existing_repos=list_existing_repos(api),
+                      journal=Journal.from_args(args, "stanza"),
+                      report=RunReport())
+
+    # languages are pushed --workers at a time, with the scheduler
+    # limiting how many of those are uploading at once.
+    # the languages with the most to upload are started first, sized
+    # with only the hashes already in the cache, and the next languages
+    # are hashed while the current ones upload.
+    # a failure in one language doesn't stop the others
+    print("Processing languages: {}".format(args.lang))
+    results = run_largest_first(ctx, args, args.lang,
+                                lambda model: plan_language(hash_cache, args, input_dir, model, hash_file=hash_cache.lookup),
+                                lambda model: push_language(ctx, args, input_dir, model),
+                                describe=get_repo_id,
+                                prepare_fn=lambda model: hash_language(ctx, input_dir, model))
+    finish_run(ctx, args, results, http_pool, "stanza")
 
 if __name__ == '__main__':
     push_to_hub()
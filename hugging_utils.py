@@ -0,0 +1,1358 @@
+"""
+Helpers shared by hugging_corenlp.py and hugging_stanza.py
+
+Both scripts take the options in add_push_args:
+
+Use --workers N to push up to N repos at the same time.  --max_uploads
+and --max_metadata_calls limit how many repos are uploading and how
+many of the cheaper Hub calls are in flight at once.  Each uploading
+repo sends up to --upload_threads files at a time
+
+--max_upload_mbps caps the total bandwidth of all the uploads in
+flight, so many repos can be pushed at once at a predictable rate
+
+Use --plan to see which files would be pushed and roughly how long
+it would take, without contacting the Hub
+
+Progress is recorded in a journal in --output_dir.  If a run dies
+partway through, rerun it with --resume to skip the finished work
+"""
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete, constants
+try:
+    from huggingface_hub._commit_api import UploadInfo, _validate_path_in_repo
+except ImportError:
+    # without these, the commit operations hash their files themselves
+    UploadInfo = None
+
+# name is the repo (or other item) that was pushed
+# result is whatever the push function returned, such as the repo url
+# error is the exception raised by the push function, or None
+PushResult = namedtuple("PushResult", 'name, result, error')
+
+# size in bytes, sha256 if the file is stored in LFS (otherwise None),
+# and the git blob id of the file
+RemoteFile = namedtuple("RemoteFile", 'size, sha256, blob_id')
+
+# directories which are never part of a repo's contents
+# .cache/huggingface is created by hf_hub_download with a local_dir
+IGNORED_DIRS = (".git", os.path.join(".cache", "huggingface"))
+
+# the shared state used while pushing each repo
+PushContext = namedtuple("PushContext", 'api, scheduler, hash_cache, existing_repos, journal, report')
+
+# a description of what pushing a repo would do, as computed by --plan
+# error is set instead if the local files could not be found
+PlanEntry = namedtuple("PlanEntry", 'repo_id, total_files, total_bytes, upload_files, upload_bytes, deleted_files, known_remote, error')
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# files at least this big are hashed in the process pool,
+# smaller ones are not worth the overhead of sending to a worker
+PARALLEL_HASH_SIZE = 16 * 1024 * 1024
+
+def positive_float(text):
+    """
+    argparse type for a float which must be greater than 0, such as a bandwidth
+    """
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError("must be greater than 0, got %s" % text)
+    return value
+
+def add_push_args(parser):
+    """
+    Add the arguments which control how the pushes are run
+    """
+    parser.add_argument('--workers', type=int, default=1, help='Number of repos to push at the same time')
+    parser.add_argument('--max_uploads', type=int, default=4, help='Maximum number of repos uploading at once, regardless of --workers')
+    parser.add_argument('--upload_threads', type=int, default=5, help='Number of files each uploading repo sends at once.  Up to --max_uploads times this many files are transferred at the same time')
+    parser.add_argument('--max_metadata_calls', type=int, default=16, help='Maximum number of cheap Hub calls (create repo, list refs, tags) in flight at once')
+    parser.add_argument('--max_upload_mbps', '--max-upload-mbps', type=positive_float, default=None, help='Cap on the total upload bandwidth of all the uploads in flight, in megabits per second.  Unlimited by default')
+    parser.add_argument('--plan', action='store_true', default=False, help='Only print what would be pushed and how long it would take, without contacting the Hub')
+    parser.add_argument('--bandwidth_mbps', type=positive_float, default=100.0, help='Upload bandwidth in megabits per second used for the --plan estimates')
+    parser.add_argument('--resume', action='store_true', default=False, help='Skip the work the release journal says was already done by an earlier run of this version')
+    parser.add_argument('--report', type=str, default=None, help='Where to write the json timing report for the run.  Defaults to reports/<script>-<version>.json in --output_dir')
+    parser.add_argument('--hash_cache', type=str, default=None, help='SQLite file caching the sha256 of local files.  Defaults to hash_cache.sqlite in --output_dir')
+    parser.add_argument('--hash_workers', type=int, default=min(8, os.cpu_count() or 1), help='Number of processes used to hash large files which are not in the hash cache')
+    parser.add_argument('--hash_ahead', type=int, default=None, help='How many repos the hashing can get ahead of the uploads.  Defaults to --workers')
+    parser.add_argument('--http_pool_size', type=int, default=None, help='Size of the HTTP connection pool: connections per host with requests (huggingface_hub 0.x), connections in total with httpx (1.x).  Defaults to enough for every Hub call the workers and upload threads can make at once, and at least 10')
+    parser.add_argument('--http_keepalive', type=float, default=60.0, help='Seconds an idle connection is kept open, with the httpx backend of huggingface_hub 1.x')
+    parser.add_argument('--no_http2', action='store_true', default=False, help='Don\'t use HTTP/2, even if the httpx backend and the h2 package are available')
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by every upload in a run
+
+    Tokens are bytes, refilled at mbps megabits per second up to
+    burst_seconds worth.  A read which takes more tokens than there are
+    puts the bucket into debt and sleeps until the debt is paid off, so
+    the concurrent uploads between them never go faster than the cap.
+    waited is the total time the uploads slept waiting for bandwidth
+    """
+    def __init__(self, mbps, burst_seconds=0.5):
+        if not mbps > 0:
+            raise ValueError("BandwidthLimiter needs a rate greater than 0, got %s" % mbps)
+        self.mbps = mbps
+        self.rate = mbps * 1000 * 1000 / 8
+        self.capacity = self.rate * burst_seconds
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def consume(self, num_bytes):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            self.tokens -= num_bytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def stats(self):
+        with self.lock:
+            return {"max_upload_mbps": self.mbps, "waited_seconds": round(self.waited, 6)}
+
+def throttle_reads(fileobj, limiter):
+    """
+    Make everything read from fileobj take bandwidth from limiter
+
+    read is replaced on the file object itself, as tqdm_stream_file in
+    huggingface_hub does, so the file is still an io.IOBase and
+    http_backoff can seek back to the start to retry an upload
+    """
+    read = fileobj.read
+
+    def throttled_read(size=-1):
+        data = read(size)
+        if data:
+            limiter.consume(len(data))
+        return data
+
+    fileobj.read = throttled_read
+
+@dataclass
+class ThrottledCommitOperationAdd(CommitOperationAdd):
+    """
+    CommitOperationAdd whose contents are read through a BandwidthLimiter, if it has one
+
+    huggingface_hub reads the file through as_file for both the LFS
+    upload and the contents of regular files in the commit.  Uploads
+    which hf_transfer makes straight from the path are not throttled
+
+    CommitOperationAdd reads and hashes the whole file when it is
+    created.  If known_sha256 is given for a path, such as from the
+    hash cache, only the first 512 bytes are read instead.  That needs
+    internals of huggingface_hub, and if they have moved, the file is
+    hashed again as usual
+    """
+    known_sha256: str = None
+    limiter: object = field(default=None, repr=False)
+
+    def __post_init__(self):
+        if self.known_sha256 is None or UploadInfo is None or not isinstance(self.path_or_fileobj, str):
+            super().__post_init__()
+            return
+        # the same checks as CommitOperationAdd, without the full read
+        self.path_in_repo = _validate_path_in_repo(self.path_in_repo)
+        path = os.path.normpath(os.path.expanduser(self.path_or_fileobj))
+        if not os.path.isfile(path):
+            raise ValueError(f"Provided path: '{path}' is not a file on the local file system")
+        with open(path, "rb") as fin:
+            sample = fin.read(512)
+        self.upload_info = UploadInfo(sha256=bytes.fromhex(self.known_sha256),
+                                      size=os.path.getsize(path),
+                                      sample=sample)
+
+    @contextmanager
+    def as_file(self, with_tqdm=False):
+        with super().as_file(with_tqdm=with_tqdm) as fileobj:
+            if self.limiter is not None:
+                throttle_reads(fileobj, self.limiter)
+            yield fileobj
+
+class Scheduler:
+    """
+    Limits how many uploads and how many metadata calls are in flight
+
+    Uploads are expensive, so there is a separate, usually smaller,
+    limit for them.  The limit is on repos uploading at once, and each
+    of those sends up to --upload_threads files at a time, so up to
+    max_uploads * upload_threads files are in flight.  Use as
+
+      with scheduler.upload():
+          api.upload_folder(...)
+      with scheduler.metadata():
+          api.list_repo_refs(...)
+
+    If max_upload_mbps is set, bandwidth is the BandwidthLimiter
+    which all of the uploads share
+    """
+    def __init__(self, max_uploads=1, max_metadata_calls=1, max_upload_mbps=None):
+        self.upload_slots = threading.BoundedSemaphore(max(1, max_uploads))
+        self.metadata_slots = threading.BoundedSemaphore(max(1, max_metadata_calls))
+        self.bandwidth = BandwidthLimiter(max_upload_mbps) if max_upload_mbps else None
+
+    @classmethod
+    def from_args(cls, args):
+        if args.max_upload_mbps and constants.HF_HUB_ENABLE_HF_TRANSFER:
+            print("HF_HUB_ENABLE_HF_TRANSFER is set.  Uploads made by hf_transfer do not respect --max_upload_mbps")
+        return cls(args.max_uploads, args.max_metadata_calls, args.max_upload_mbps)
+
+    def upload(self):
+        return self.upload_slots
+
+    def metadata(self):
+        return self.metadata_slots
+
+class HttpPool:
+    """
+    The HTTP connections shared by all of the Hub calls in a run
+
+    huggingface_hub 0.x makes a requests Session for each thread.  The
+    sessions made here all mount the same adapter, so the worker threads
+    share one pool of keep-alive connections, sized for pool_size calls
+    at once to each host, rather than each thread opening its own.
+
+    huggingface_hub 1.x shares one httpx Client between the threads.
+    httpx limits connections across the whole client rather than per
+    host, so the client made here opens at most pool_size connections
+    in total, keeps idle ones open for keepalive seconds, and uses
+    HTTP/2 if http2 is set and the h2 package is installed.
+
+    stats() reports how many requests were made over how many connections
+    """
+    def __init__(self, pool_size=10, keepalive=60.0, http2=True):
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.http2 = http2
+        self.lock = threading.Lock()
+        self.backend = None
+        self.adapter = None
+        self.request_hook = None
+        self.num_requests = 0
+        self.num_connections = 0
+
+    @classmethod
+    def from_args(cls, args):
+        # each worker makes one Hub call at a time, except the uploading
+        # ones, which send up to upload_threads files at once.  httpx
+        # makes calls wait for a connection beyond this, so cover them all
+        uploading = min(args.workers, args.max_uploads)
+        pool_size = args.http_pool_size if args.http_pool_size else max(10, args.workers - uploading + uploading * args.upload_threads)
+        return cls(pool_size, args.http_keepalive, not args.no_http2)
+
+    def install(self):
+        """
+        Make huggingface_hub send its requests through this pool
+        """
+        try:
+            from huggingface_hub import set_client_factory
+        except ImportError:
+            set_client_factory = None
+
+        # the request hooks and adapters huggingface_hub adds its headers
+        # with are private, so if they have moved, leave its transport alone
+        if set_client_factory is not None:
+            try:
+                from huggingface_hub.utils._http import hf_request_event_hook
+            except ImportError:
+                print("Could not find hf_request_event_hook in huggingface_hub.  Using its default HTTP client")
+                return
+            self.request_hook = hf_request_event_hook
+            self.backend = "httpx"
+            set_client_factory(self.make_client)
+        else:
+            from huggingface_hub import configure_http_backend
+            try:
+                from huggingface_hub.utils._http import UniqueRequestIdAdapter
+            except ImportError:
+                print("Could not find UniqueRequestIdAdapter in huggingface_hub.  Using its default HTTP sessions")
+                return
+            self.backend = "requests"
+            self.adapter = UniqueRequestIdAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            configure_http_backend(self.make_session)
+
+    def make_session(self):
+        import requests
+        session = requests.Session()
+        session.mount("http://", self.adapter)
+        session.mount("https://", self.adapter)
+        return session
+
+    def make_client(self):
+        import importlib.util
+        import httpx
+        http2 = self.http2 and importlib.util.find_spec("h2") is not None
+        limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size, keepalive_expiry=self.keepalive)
+        return httpx.Client(event_hooks={"request": [self.request_hook, self.count_request]},
+                            follow_redirects=True,
+                            timeout=httpx.Timeout(constants.DEFAULT_REQUEST_TIMEOUT, write=60.0),
+                            limits=limits,
+                            http2=http2)
+
+    def count_request(self, request):
+        with self.lock:
+            self.num_requests += 1
+        request.extensions["trace"] = self.trace
+
+    def trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            with self.lock:
+                self.num_connections += 1
+
+    def stats(self):
+        """
+        Return the number of requests, the number of connections they
+        needed, and the fraction of requests which reused a connection,
+        or None if install() left the default transport in place
+        """
+        if self.backend is None:
+            return None
+        if self.adapter is not None:
+            pools = self.adapter.poolmanager.pools
+            num_requests = num_connections = 0
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    num_requests += pool.num_requests
+                    num_connections += pool.num_connections
+        else:
+            with self.lock:
+                num_requests, num_connections = self.num_requests, self.num_connections
+        reuse = 1.0 - num_connections / num_requests if num_requests else 0.0
+        return {"backend": self.backend,
+                "pool_size": self.pool_size,
+                "requests": num_requests,
+                "connections": num_connections,
+                "reuse_ratio": round(max(0.0, reuse), 4)}
+
+class HashCache:
+    """
+    On disk cache of the sha256 of local files
+
+    Entries are keyed on the path, size, mtime and inode of the file,
+    so a file which is rewritten or replaced is hashed again, but an
+    unchanged model tree is never rehashed
+    """
+    def __init__(self, path, workers=1):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS hashes "
+                              "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, sha256 TEXT)")
+
+    @classmethod
+    def from_args(cls, args):
+        path = args.hash_cache if args.hash_cache else os.path.join(args.output_dir, "hash_cache.sqlite")
+        return cls(path, args.hash_workers)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def lookup(self, path):
+        """
+        Return the cached sha256 of path, or None if the file changed since it was hashed
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime_ns, inode, sha256 FROM hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return row[3]
+        return None
+
+    def store(self, path, sha256, stat=None):
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)",
+                              (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, sha256))
+
+    def sha256(self, path):
+        """
+        Return the sha256 of path, hashing it only if the cached value is stale
+        """
+        sha256 = self.lookup(path)
+        if sha256 is not None:
+            return sha256
+        # stat before hashing so that a file modified while being
+        # hashed is treated as stale on the next run
+        stat = os.stat(path)
+        sha256 = sha256_file(path)
+        self.store(path, sha256, stat)
+        return sha256
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # spawn rather than fork, since the parent has threads running
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.pool
+
+    def hash_files(self, paths):
+        """
+        Make sure every one of paths is in the cache, returning a map from path to sha256
+
+        Large files which aren't cached are hashed concurrently in a
+        pool of worker processes, so hashing scales with the cores and
+        the disk rather than being limited to one thread
+        """
+        return self.start_hashing(paths).result()
+
+    def start_hashing(self, paths):
+        """
+        Start hashing the files in paths which aren't cached, returning a HashJob
+
+        Small files are hashed right away, and large ones are sent to
+        the process pool, so several calls can keep the pool busy at once
+        """
+        job = HashJob(self)
+        for path in paths:
+            sha256 = self.lookup(path)
+            if sha256 is not None:
+                job.results[path] = sha256
+                continue
+            stat = os.stat(path)
+            job.num_bytes += stat.st_size
+            if self.workers > 1 and stat.st_size >= PARALLEL_HASH_SIZE:
+                job.futures[path] = (self.get_pool().submit(sha256_file, path), stat)
+            else:
+                job.results[path] = sha256_file(path)
+                self.store(path, job.results[path], stat)
+        return job
+
+class HashJob:
+    """
+    The hashes started by HashCache.start_hashing
+
+    result() waits for the files still being hashed, stores them in
+    the cache, and returns the map from path to sha256 of all the files.
+    num_bytes is the size of the files which were not in the cache
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.num_bytes = 0
+        self.results = {}
+        # path -> (future, stat of the file before it was hashed)
+        self.futures = {}
+
+    def result(self):
+        for path, (future, stat) in self.futures.items():
+            self.results[path] = future.result()
+            self.cache.store(path, self.results[path], stat)
+        self.futures = {}
+        return self.results
+
+class Journal:
+    """
+    Append-only record of which phases of a release each repo has completed
+
+    Each line is a json record such as
+      {"repo_id": "stanfordnlp/stanza-en", "phase": "commit", "commit": "<sha>"}
+    The phases are "repo" (the repo exists), "part" (one part of a
+    commit split by commit_files, with the part number), "commit" (the
+    files were committed, with the sha of the commit, or None if
+    nothing changed) and "tag" (the version tag was created).
+
+    A run without resume writes a "start" record, which makes the phases
+    recorded before it be ignored, so the file never has to be rewritten
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.phases = {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if resume and os.path.exists(path):
+            self.load()
+        if not resume:
+            self.append({"phase": "start"})
+
+    @classmethod
+    def from_args(cls, args, script_name):
+        path = os.path.join(args.output_dir, "journal", "%s-%s.jsonl" % (script_name, args.version))
+        return cls(path, args.resume)
+
+    def load(self):
+        with open(self.path) as fin:
+            for line in fin:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by a crash
+                    continue
+                if record["phase"] == "start":
+                    self.phases = {}
+                else:
+                    self.phases.setdefault(record["repo_id"], {})[record["phase"]] = record
+        print("Resuming from %s: %d repos have completed phases" % (self.path, len(self.phases)))
+
+    def append(self, record):
+        with self.lock:
+            with open(self.path, "a") as fout:
+                fout.write(json.dumps(record) + "\n")
+                fout.flush()
+                os.fsync(fout.fileno())
+
+    def record(self, repo_id, phase, **kwargs):
+        """
+        Record that repo_id completed phase, with any extra information in kwargs
+        """
+        record = dict(repo_id=repo_id, phase=phase, **kwargs)
+        self.append(record)
+        with self.lock:
+            self.phases.setdefault(repo_id, {})[phase] = record
+
+    def get(self, repo_id, phase):
+        """
+        Return the record of repo_id completing phase, or None if it hasn't
+        """
+        with self.lock:
+            return self.phases.get(repo_id, {}).get(phase)
+
+class RunReport:
+    """
+    Wall time, bytes and call counts of each phase of each repo's push
+
+    Use as
+
+      with report.phase(repo_id, "upload", num_bytes=size):
+          ...
+
+    The phases of a repo are summed, so a phase which happens
+    several times for one repo shows up with a call count
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        # (repo_id, phase) -> [seconds, bytes, calls]
+        self.phases = {}
+        # set by run_largest_first
+        self.makespan = None
+        # set by run_pushes
+        self.stages = None
+        # the stats of the HttpPool, if the run made real Hub calls
+        self.http = None
+        # the stats of the BandwidthLimiter, if there was a --max_upload_mbps
+        self.bandwidth = None
+
+    @contextmanager
+    def phase(self, repo_id, phase, num_bytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(repo_id, phase, time.perf_counter() - start, num_bytes)
+
+    def add(self, repo_id, phase, seconds, num_bytes=0, calls=1):
+        with self.lock:
+            totals = self.phases.setdefault((repo_id, phase), [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += num_bytes
+            totals[2] += calls
+
+    def record_makespan(self, predicted, actual, bandwidth_mbps, order):
+        """
+        Record the predicted and actual time of the pushes, and the order
+        they were started in, as a list of (repo_id, pending bytes)
+        """
+        with self.lock:
+            self.makespan = {"predicted_seconds": round(predicted, 6),
+                             "actual_seconds": round(actual, 6),
+                             "bandwidth_mbps": bandwidth_mbps,
+                             "order": [{"repo_id": repo_id, "pending_bytes": num_bytes} for repo_id, num_bytes in order]}
+
+    def record_stages(self, stages):
+        with self.lock:
+            self.stages = stages
+
+    def record_http(self, stats):
+        with self.lock:
+            self.http = stats
+
+    def record_bandwidth(self, stats):
+        with self.lock:
+            self.bandwidth = stats
+
+    def to_json(self):
+        with self.lock:
+            records = [{"repo_id": repo_id, "phase": phase, "seconds": round(seconds, 6), "bytes": num_bytes, "calls": calls}
+                       for (repo_id, phase), (seconds, num_bytes, calls) in sorted(self.phases.items())]
+            makespan = self.makespan
+            http = self.http
+            stages = self.stages
+            bandwidth = self.bandwidth
+        return {"start_time": self.start_time,
+                "wall_seconds": round(time.time() - self.start_time, 6),
+                "makespan": makespan,
+                "stages": stages,
+                "http": http,
+                "bandwidth": bandwidth,
+                "phases": records}
+
+    def write(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fout:
+            json.dump(self.to_json(), fout, indent=2)
+        print("Wrote timing report to %s" % path)
+
+    @staticmethod
+    def default_path(args, script_name):
+        if args.report:
+            return args.report
+        return os.path.join(args.output_dir, "reports", "%s-%s.json" % (script_name, args.version))
+
+    def print_summary(self, num_repos=5):
+        """
+        Print the total time of each phase and the slowest repos
+        """
+        by_phase = {}
+        by_repo = {}
+        with self.lock:
+            for (repo_id, phase), (seconds, num_bytes, calls) in self.phases.items():
+                totals = by_phase.setdefault(phase, [0.0, 0, 0])
+                totals[0] += seconds
+                totals[1] += num_bytes
+                totals[2] += calls
+                by_repo[repo_id] = by_repo.get(repo_id, 0.0) + seconds
+
+        print()
+        print("%-12s %10s %12s %6s" % ("phase", "seconds", "bytes", "calls"))
+        for phase, (seconds, num_bytes, calls) in sorted(by_phase.items(), key=lambda x: -x[1][0]):
+            print("%-12s %10.2f %12s %6d" % (phase, seconds, format_bytes(num_bytes), calls))
+
+        print()
+        print("Slowest repos:")
+        for repo_id, seconds in sorted(by_repo.items(), key=lambda x: -x[1])[:num_repos]:
+            phases = sorted(((phase, totals[0]) for (repo, phase), totals in self.phases.items() if repo == repo_id),
+                            key=lambda x: -x[1])
+            detail = ", ".join("%s %.2fs" % x for x in phases[:3])
+            print("  %-40s %8.2fs  (%s)" % (repo_id, seconds, detail))
+
+        if self.makespan is not None:
+            print()
+            print("Makespan: predicted %s at %g Mbps, actual %s" % (format_duration(self.makespan["predicted_seconds"]),
+                                                                  self.makespan["bandwidth_mbps"],
+                                                                  format_duration(self.makespan["actual_seconds"])))
+        if self.stages is not None:
+            for name, stage in self.stages.items():
+                print("Stage %-8s %3.0f%% busy over %d threads, %.2fs waiting on the queue" %
+                      (name, 100 * stage["utilization"], stage["threads"], stage["blocked_seconds"]))
+        if self.http is not None:
+            print("HTTP: %d requests over %d connections (%s backend), %.0f%% reused a connection" %
+                  (self.http["requests"], self.http["connections"], self.http["backend"], 100 * self.http["reuse_ratio"]))
+        if self.bandwidth is not None:
+            print("Uploads waited %.2fs in total for bandwidth under the %g Mbps cap" %
+                  (self.bandwidth["waited_seconds"], self.bandwidth["max_upload_mbps"]))
+
+class PipelineStage:
+    """
+    Time a stage of run_pushes spends working and waiting on the queue between the stages
+
+    For the prepare stage, blocked is time spent waiting for room in the
+    queue, which means it is ahead of the pushes.  For the push stage, it
+    is time spent waiting for an item to be prepared, which means the
+    pushes are starved
+    """
+    def __init__(self, threads):
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+
+    @contextmanager
+    def busy(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.busy_seconds += time.perf_counter() - start
+
+    @contextmanager
+    def blocked(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.blocked_seconds += time.perf_counter() - start
+
+    def to_json(self, wall_seconds):
+        utilization = self.busy_seconds / (self.threads * wall_seconds) if wall_seconds > 0 else 0.0
+        return {"threads": self.threads,
+                "busy_seconds": round(self.busy_seconds, 6),
+                "blocked_seconds": round(self.blocked_seconds, 6),
+                "utilization": round(utilization, 4)}
+
+def wait_for_hashes(ctx, repo_id, job, start):
+    """
+    Wait for the HashJob job, returning its hashes
+
+    If any files had to be hashed, the time since start and the bytes
+    hashed go in the report.  Files found in the cache aren't counted
+    """
+    hashes = job.result()
+    if job.num_bytes > 0:
+        ctx.report.add(repo_id, "hash", time.perf_counter() - start, job.num_bytes)
+    return hashes
+
+def prefetch_hashes(ctx, repo_id, paths):
+    """
+    Start hashing paths for repo_id, as the prepare_fn of run_pushes
+
+    Returns a function which waits for the hashes and records the
+    time they took in the report
+    """
+    start = time.perf_counter()
+    job = ctx.hash_cache.start_hashing(paths)
+    return lambda: wait_for_hashes(ctx, repo_id, job, start)
+
+def run_pushes(items, push_fn, workers=1, describe=str, prepare_fn=None, depth=1, report=None):
+    """
+    Call push_fn on each of the items, using at most workers threads
+
+    If prepare_fn is given, such as hashing an item's files, it is run
+    on each item, in order, in a stage of its own which works ahead of
+    the pushes.  prepare_fn starts preparing an item and returns None
+    if it is already done, or a function which waits for it to finish.
+    Up to depth items are being prepared at once, and up to depth more
+    wait in a bounded queue for the pushes, so the preparation can't run
+    arbitrarily far ahead, and the pushes of the current items overlap
+    the preparation of the next ones.  The busy time and utilization of
+    each stage are recorded in report.
+
+    An exception in one push, or in its preparation, is recorded in its
+    PushResult instead of stopping the other pushes.  Results are
+    returned in the order of items
+    """
+    workers = max(1, min(workers, len(items)))
+    depth = max(1, depth)
+    results = [None] * len(items)
+    ready = queue.Queue(maxsize=depth)
+    stages = {"prepare": PipelineStage(1), "push": PipelineStage(workers)}
+    start = time.perf_counter()
+
+    def run_prepare_step(fn, item):
+        with stages["prepare"].busy():
+            try:
+                return fn(item), None
+            except Exception as e:
+                print(f"Error while preparing {describe(item)}")
+                traceback.print_exc()
+                return None, e
+
+    def prepare():
+        # (index, item, function to wait for the item, error)
+        in_progress = deque()
+
+        def finish_oldest():
+            index, item, wait, error = in_progress.popleft()
+            if wait is not None:
+                _, error = run_prepare_step(lambda item: wait(), item)
+            with stages["prepare"].blocked():
+                ready.put((index, item, error))
+
+        for index, item in enumerate(items):
+            wait, error = None, None
+            if prepare_fn is not None:
+                wait, error = run_prepare_step(prepare_fn, item)
+            in_progress.append((index, item, wait, error))
+            if len(in_progress) >= depth:
+                finish_oldest()
+        while in_progress:
+            finish_oldest()
+        for _ in range(workers):
+            ready.put(None)
+
+    def push():
+        while True:
+            with stages["push"].blocked():
+                entry = ready.get()
+            if entry is None:
+                return
+            index, item, error = entry
+            name = describe(item)
+            if error is not None:
+                results[index] = PushResult(name, None, error)
+                continue
+            with stages["push"].busy():
+                try:
+                    results[index] = PushResult(name, push_fn(item), None)
+                except Exception as e:
+                    print(f"Error while pushing {name}")
+                    traceback.print_exc()
+                    results[index] = PushResult(name, None, e)
+
+    with ThreadPoolExecutor(max_workers=workers + 1) as executor:
+        futures = [executor.submit(prepare)] + [executor.submit(push) for _ in range(workers)]
+        for future in futures:
+            future.result()
+
+    if report is not None:
+        wall = time.perf_counter() - start
+        report.record_stages({name: stage.to_json(wall) for name, stage in stages.items()})
+    return results
+
+def predict_makespan(sizes, streams, bandwidth_mbps):
+    """
+    Predict how long uploading jobs of the given sizes takes, started in order
+
+    At most streams jobs upload at once, and bandwidth_mbps is split
+    equally between the jobs which are uploading, so a job left on its
+    own gets all of it.  Each job starts as soon as a stream is free,
+    as in run_pushes.  Jobs with nothing to upload take no time.  Only
+    the transfers are counted, not the Hub calls
+    """
+    rate = bandwidth_mbps * 1000 * 1000 / 8
+    pending = [size for size in sizes if size > 0]
+    streams = max(1, min(streams, len(pending)))
+    active = []
+    elapsed = 0.0
+    while pending or active:
+        while pending and len(active) < streams:
+            active.append(pending.pop(0))
+        share = rate / len(active)
+        step = min(active) / share
+        elapsed += step
+        active = [remaining - step * share for remaining in active]
+        active = [remaining for remaining in active if remaining > 1e-6]
+    return elapsed
+
+def run_largest_first(ctx, args, items, plan_fn, push_fn, describe=str, prepare_fn=None):
+    """
+    Call push_fn on each of the items, starting the ones with the most bytes to upload first
+
+    plan_fn returns the PlanEntry of an item, which is only computed from
+    local files and cached manifests.  Items whose commit is in the
+    journal, or which could not be planned, have nothing pending.
+    Starting the largest pushes first keeps one big repo from starting
+    last and running alone at the end of the release.  The predicted and
+    actual makespan go in the run report.
+
+    prepare_fn, such as hashing, runs ahead of the pushes as described
+    in run_pushes.  Results are returned in the order of items
+    """
+    def size_one(item):
+        # an item which can't be sized still gets pushed, and fails
+        # on its own, so one bad file doesn't stop the release
+        try:
+            return plan_fn(item)
+        except Exception as e:
+            print("Could not size %s: %s" % (describe(item), e))
+            return plan_error(describe(item), e)
+
+    with ctx.report.phase("all", "size"):
+        entries = {item: size_one(item) for item in items}
+    sizes = {}
+    for item, entry in entries.items():
+        if entry.error is not None or ctx.journal.get(entry.repo_id, "commit"):
+            sizes[item] = 0
+        else:
+            sizes[item] = entry.upload_bytes
+    order = sorted(items, key=lambda item: -sizes[item])
+
+    bandwidth_mbps = args.max_upload_mbps if args.max_upload_mbps else args.bandwidth_mbps
+    streams = min(args.workers, args.max_uploads)
+    predicted = predict_makespan([sizes[item] for item in order], streams, bandwidth_mbps)
+    print("Pushing %d repos, %s pending, largest first.  Predicted time %s at %g Mbps" %
+          (len(items), format_bytes(sum(sizes.values())), format_duration(predicted), bandwidth_mbps))
+
+    start = time.perf_counter()
+    depth = args.hash_ahead if args.hash_ahead else args.workers
+    results = run_pushes(order, push_fn, workers=args.workers, describe=describe,
+                         prepare_fn=prepare_fn, depth=depth, report=ctx.report)
+    actual = time.perf_counter() - start
+    ctx.report.record_makespan(predicted, actual, bandwidth_mbps, [(describe(item), sizes[item]) for item in order])
+    by_item = dict(zip(order, results))
+    return [by_item[item] for item in items]
+
+def print_summary(results):
+    """
+    Print which pushes succeeded and which failed
+
+    Returns the number of failed pushes
+    """
+    failures = [x for x in results if x.error is not None]
+    print()
+    print("Pushed %d of %d repos" % (len(results) - len(failures), len(results)))
+    for result in results:
+        if result.error is None:
+            print(f"  OK      {result.name}  {result.result}")
+        else:
+            print(f"  FAILED  {result.name}  {type(result.error).__name__}: {result.error}")
+    return len(failures)
+
+def finish_run(ctx, args, results, http_pool, script_name):
+    """
+    Print the summary and the report of a run, write the report, and
+    exit with an error if any of the pushes failed
+    """
+    ctx.hash_cache.close()
+    num_failures = print_summary(results)
+    if http_pool is not None:
+        ctx.report.record_http(http_pool.stats())
+    if ctx.scheduler.bandwidth is not None:
+        ctx.report.record_bandwidth(ctx.scheduler.bandwidth.stats())
+    ctx.report.print_summary()
+    ctx.report.write(RunReport.default_path(args, script_name))
+    if num_failures > 0:
+        sys.exit(1)
+
+def list_existing_repos(api, organization="stanfordnlp"):
+    """
+    Return the set of ids of the models which already exist in organization
+
+    This is a single paginated listing, which replaces a create_repo
+    call per repo when nearly all of them already exist
+    """
+    return set(model.id for model in api.list_models(author=organization))
+
+def get_repo_url(api, repo_id):
+    return f"{api.endpoint}/{repo_id}"
+
+def ensure_repo(api, repo_id, existing_repos):
+    """
+    Create repo_id unless existing_repos says it is already there
+
+    Returns the url of the repo
+    """
+    if repo_id in existing_repos:
+        return get_repo_url(api, repo_id)
+    repo_url = api.create_repo(repo_id=repo_id, exist_ok=True)
+    existing_repos.add(repo_id)
+    return repo_url
+
+def get_head_commit(refs, branch="main"):
+    """
+    Return the commit the given branch of a repo points at, or None
+    """
+    for ref in refs.branches:
+        if ref.name == branch:
+            return ref.target_commit
+    return None
+
+def version_key(tag_name):
+    """
+    Turn a tag such as v1.10.0 into (1, 10, 0), or None if it isn't a version tag
+    """
+    if not tag_name.startswith("v"):
+        return None
+    try:
+        return tuple(int(x) for x in tag_name[1:].split("."))
+    except ValueError:
+        return None
+
+def find_previous_version_tag(refs, new_tag_name):
+    """
+    Return the GitRefInfo of the latest version tag before new_tag_name, or None
+    """
+    new_key = version_key(new_tag_name)
+    candidates = []
+    for tag in refs.tags:
+        key = version_key(tag.name)
+        if key is None or tag.name == new_tag_name:
+            continue
+        if new_key is not None and key > new_key:
+            continue
+        candidates.append((key, tag))
+    if not candidates:
+        return None
+    return max(candidates, key=lambda x: x[0])[1]
+
+def update_tag(api, repo_id, tag_name, tag_message, commit=None, refs=None):
+    """
+    Make tag_name point at commit, or at the head of main if commit is None
+
+    A tag which already points at the right commit is left alone, so
+    rerunning a release doesn't churn the tags.  refs can be passed in
+    if they were just listed.  Returns True if the tag was created or moved
+    """
+    if refs is None:
+        refs = api.list_repo_refs(repo_id=repo_id)
+    if commit is None:
+        commit = get_head_commit(refs)
+    existing = next((tag for tag in refs.tags if tag.name == tag_name), None)
+    if existing is not None:
+        if existing.target_commit == commit:
+            return False
+        # the Hub can't move a tag, so it has to be replaced
+        api.delete_tag(repo_id=repo_id, tag=tag_name)
+    api.create_tag(repo_id=repo_id, tag=tag_name, tag_message=tag_message, revision=commit)
+    return True
+
+def commit_files(ctx, args, repo_id, local_files, remote_manifest, delete_patterns=None, max_bytes=None, max_files=None):
+    """
+    Commit the files in local_files which differ from remote_manifest to repo_id
+
+    If max_bytes or max_files are set, the changes are split into
+    several commits of at most that size, as described in
+    split_operations.  Each part is recorded in the journal and the
+    saved remote manifest as soon as it is committed, so if a later
+    part fails, the next run only sends what isn't on the Hub yet.
+
+    Returns the sha of the last new commit, or None if nothing changed.
+    The updated remote manifest is saved for --plan, and the commit is
+    recorded in the journal
+    """
+    local_paths = [x for x in local_files.values() if not isinstance(x, bytes)]
+    # usually everything was hashed by the prepare stage, and these are cache lookups
+    hashes = wait_for_hashes(ctx, repo_id, ctx.hash_cache.start_hashing(local_paths), time.perf_counter())
+    with ctx.report.phase(repo_id, "compare"):
+        changed, deleted = find_changes(local_files, remote_manifest, delete_patterns, hash_file=ctx.hash_cache.sha256)
+    upload_bytes = sum(local_size(local_files[x]) for x in changed)
+    with ctx.report.phase(repo_id, "prepare", num_bytes=upload_bytes):
+        operations = build_operations(local_files, changed, deleted, hashes, ctx.scheduler.bandwidth)
+        parts = split_operations(operations, max_bytes, max_files)
+
+    part_record = ctx.journal.get(repo_id, "part")
+    if part_record:
+        print("%d of %d parts were already committed to %s" % (part_record["part"], part_record["parts"], repo_id))
+
+    commit = None
+    if parts:
+        if len(parts) == 1:
+            print("Pushing %d changed files to %s" % (len(operations), repo_id))
+        else:
+            print("Pushing %d changed files to %s in %d commits" % (len(operations), repo_id, len(parts)))
+    else:
+        print("Nothing changed in %s" % repo_id)
+    for part_idx, part in enumerate(parts):
+        additions = [x for x in part if isinstance(x, CommitOperationAdd)]
+        part_bytes = sum(x.upload_info.size for x in additions)
+        commit_message = f"Add model {args.version}"
+        if len(parts) > 1:
+            commit_message = commit_message + " (part %d of %d)" % (part_idx + 1, len(parts))
+        # the LFS transfer is done separately from the commit so that
+        # the time spent on each of them shows up in the report
+        with ctx.scheduler.upload(), ctx.report.phase(repo_id, "upload", num_bytes=part_bytes):
+            ctx.api.preupload_lfs_files(repo_id=repo_id, additions=additions, num_threads=args.upload_threads)
+        with ctx.scheduler.metadata(), ctx.report.phase(repo_id, "commit"):
+            commit = ctx.api.create_commit(repo_id=repo_id, operations=part, commit_message=commit_message).oid
+        remote_manifest = apply_operations(remote_manifest, part)
+        if len(parts) > 1:
+            save_remote_manifest(args.output_dir, repo_id, remote_manifest)
+            ctx.journal.record(repo_id, "part", commit=commit, part=part_idx + 1, parts=len(parts))
+    save_remote_manifest(args.output_dir, repo_id, remote_manifest)
+    ctx.journal.record(repo_id, "commit", commit=commit)
+    return commit
+
+def split_operations(operations, max_bytes=None, max_files=None):
+    """
+    Split the operations of a commit into parts of at most max_bytes and max_files operations
+
+    Deletions count towards max_files but not max_bytes, and a single
+    file larger than max_bytes gets a part of its own.  The new files
+    go first, then the deletions, then the model card, so old models
+    are only removed, and the card only updated, once all of the new
+    files are on the Hub.  Returns a list of lists of operations,
+    which is empty if there are no operations
+    """
+    if not operations:
+        return []
+    if not max_bytes and not max_files:
+        return [operations]
+
+    deletions = [x for x in operations if isinstance(x, CommitOperationDelete)]
+    cards = [x for x in operations if not isinstance(x, CommitOperationDelete) and x.path_in_repo == "README.md"]
+    additions = [x for x in operations if not isinstance(x, CommitOperationDelete) and x.path_in_repo != "README.md"]
+
+    parts = []
+    part = []
+    part_bytes = 0
+    for operation in additions + deletions + cards:
+        size = 0 if isinstance(operation, CommitOperationDelete) else operation.upload_info.size
+        if part and ((max_files and len(part) >= max_files) or (max_bytes and part_bytes + size > max_bytes)):
+            parts.append(part)
+            part = []
+            part_bytes = 0
+        part.append(operation)
+        part_bytes += size
+    parts.append(part)
+    return parts
+
+def tag_version(ctx, args, repo_id, commit, refs=None):
+    """
+    Tag commit (or the head of main if None) with the version being pushed
+    """
+    new_tag_name = "v" + args.version
+    with ctx.scheduler.metadata(), ctx.report.phase(repo_id, "tag"):
+        # Tag model version, unless the tag is already at the new head
+        tag_moved = update_tag(ctx.api, repo_id, new_tag_name, f"Adding new version of models {new_tag_name}", commit, refs)
+    if tag_moved:
+        print(f"Added a tag for the new models: {new_tag_name}")
+    else:
+        print(f"Tag {new_tag_name} is already up to date")
+    ctx.journal.record(repo_id, "tag", tag=new_tag_name)
+
+def sha256_file(path):
+    """
+    Return the hex sha256 of the file at path
+
+    The file is memory mapped rather than read into buffers, which
+    avoids copying multi-GB artifacts through Python
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as fin:
+        if os.fstat(fin.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return sha.hexdigest()
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for start in range(0, len(view), HASH_CHUNK_SIZE):
+                    sha.update(view[start:start + HASH_CHUNK_SIZE])
+            finally:
+                view.release()
+    return sha.hexdigest()
+
+def git_blob_sha1(data):
+    """
+    Return the git blob id of data, which is how git identifies non-LFS files
+    """
+    sha = hashlib.sha1()
+    sha.update(b"blob %d\0" % len(data))
+    sha.update(data)
+    return sha.hexdigest()
+
+def content_digest(local_files, hash_file=sha256_file):
+    """
+    Return a sha256 summarizing the paths and contents of local_files
+
+    local_files maps path in repo to either a local path or a bytes blob.
+    The digest only changes when a file is added, removed or changed
+    """
+    digest = hashlib.sha256()
+    for path_in_repo, local in sorted(local_files.items()):
+        if isinstance(local, bytes):
+            sha256 = hashlib.sha256(local).hexdigest()
+        else:
+            sha256 = hash_file(local)
+        digest.update(("%s %s\n" % (path_in_repo, sha256)).encode())
+    return digest.hexdigest()
+
+def list_local_files(folder):
+    """
+    Return a map from path in repo to local path for every file under folder
+    """
+    local_files = {}
+    for root, dirs, files in os.walk(folder):
+        rel_root = os.path.relpath(root, folder)
+        dirs[:] = [d for d in dirs if os.path.normpath(os.path.join(rel_root, d)) not in IGNORED_DIRS]
+        for filename in files:
+            path_in_repo = os.path.normpath(os.path.join(rel_root, filename)).replace(os.sep, "/")
+            local_files[path_in_repo] = os.path.join(root, filename)
+    return local_files
+
+def get_remote_manifest(api, repo_id, revision=None):
+    """
+    Return a map from path to RemoteFile for every file in the remote repo
+
+    This is a single listing call, so it is much cheaper than
+    negotiating each file's upload with the Hub
+    """
+    manifest = {}
+    for entry in api.list_repo_tree(repo_id=repo_id, recursive=True, revision=revision):
+        if not hasattr(entry, "blob_id"):
+            # folders have no contents of their own
+            continue
+        sha256 = entry.lfs.sha256 if entry.lfs else None
+        manifest[entry.path] = RemoteFile(entry.size, sha256, entry.blob_id)
+    return manifest
+
+def is_changed(local, remote, hash_file=sha256_file):
+    """
+    Check if local, either a path or a bytes blob, differs from the RemoteFile remote
+
+    The size is compared first so that most changed files don't need to be hashed
+    """
+    if remote is None:
+        return True
+    if isinstance(local, bytes):
+        if len(local) != remote.size:
+            return True
+        if remote.sha256:
+            return hashlib.sha256(local).hexdigest() != remote.sha256
+        return git_blob_sha1(local) != remote.blob_id
+
+    if os.path.getsize(local) != remote.size:
+        return True
+    if remote.sha256:
+        return hash_file(local) != remote.sha256
+    with open(local, "rb") as fin:
+        return git_blob_sha1(fin.read()) != remote.blob_id
+
+def find_changes(local_files, remote_manifest, delete_patterns=None, hash_file=sha256_file):
+    """
+    Find the changes needed to make the remote repo match local_files
+
+    local_files maps path in repo to either a local path or a bytes blob.
+    Returns the paths of the files which differ from remote_manifest and
+    need to be uploaded, and the paths of remote files which match one of
+    delete_patterns and are not in local_files, which need to be deleted,
+    as with the delete_patterns of upload_folder
+    """
+    changed = [path_in_repo for path_in_repo, local in sorted(local_files.items())
+               if is_changed(local, remote_manifest.get(path_in_repo), hash_file)]
+
+    deleted = []
+    if delete_patterns:
+        if isinstance(delete_patterns, str):
+            delete_patterns = [delete_patterns]
+        for path_in_repo in sorted(remote_manifest):
+            if path_in_repo in local_files:
+                continue
+            if any(fnmatch.fnmatch(path_in_repo, pattern) for pattern in delete_patterns):
+                deleted.append(path_in_repo)
+    return changed, deleted
+
+def build_operations(local_files, changed, deleted, hashes=None, limiter=None):
+    """
+    Build the commit operations for the changes returned by find_changes
+
+    hashes maps local paths to their known sha256.  These are given to
+    the operations so that huggingface_hub doesn't read and hash the
+    files again when the operations are created.
+    If limiter is a BandwidthLimiter, the uploads of the files go through it
+    """
+    operations = []
+    for path_in_repo in changed:
+        local = local_files[path_in_repo]
+        known_sha256 = hashes.get(local) if hashes and not isinstance(local, bytes) else None
+        operations.append(ThrottledCommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=local,
+                                                      known_sha256=known_sha256, limiter=limiter))
+    operations.extend(CommitOperationDelete(path_in_repo=path_in_repo) for path_in_repo in deleted)
+    return operations
+
+def apply_operations(remote_manifest, operations):
+    """
+    Return a copy of remote_manifest updated with the effect of a commit of operations
+    """
+    remote_manifest = dict(remote_manifest)
+    for operation in operations:
+        if isinstance(operation, CommitOperationDelete):
+            remote_manifest.pop(operation.path_in_repo, None)
+        else:
+            upload_info = operation.upload_info
+            remote_manifest[operation.path_in_repo] = RemoteFile(upload_info.size, upload_info.sha256.hex(), None)
+    return remote_manifest
+
+def manifest_cache_path(cache_dir, repo_id):
+    return os.path.join(cache_dir, "manifests", repo_id.replace("/", "--") + ".json")
+
+def save_remote_manifest(cache_dir, repo_id, remote_manifest):
+    """
+    Save the remote manifest of repo_id so that --plan can use it without the network
+    """
+    path = manifest_cache_path(cache_dir, repo_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as fout:
+        json.dump({path_in_repo: list(remote) for path_in_repo, remote in remote_manifest.items()}, fout, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def load_remote_manifest(cache_dir, repo_id):
+    """
+    Load the manifest saved by save_remote_manifest, or None if there isn't one
+    """
+    path = manifest_cache_path(cache_dir, repo_id)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        return {path_in_repo: RemoteFile(*remote) for path_in_repo, remote in json.load(fin).items()}
+
+def plan_repo(repo_id, local_files, remote_manifest, delete_patterns=None, hash_file=sha256_file):
+    """
+    Describe what pushing local_files to repo_id would do, without touching the Hub
+
+    If remote_manifest is None, as when the repo has never been pushed
+    from this machine, every file is assumed to need uploading
+    """
+    if remote_manifest is None:
+        changed, deleted = sorted(local_files), []
+    else:
+        changed, deleted = find_changes(local_files, remote_manifest, delete_patterns, hash_file)
+    return PlanEntry(repo_id=repo_id,
+                     total_files=len(local_files),
+                     total_bytes=sum(local_size(x) for x in local_files.values()),
+                     upload_files=len(changed),
+                     upload_bytes=sum(local_size(local_files[x]) for x in changed),
+                     deleted_files=len(deleted),
+                     known_remote=remote_manifest is not None,
+                     error=None)
+
+def plan_error(repo_id, error):
+    return PlanEntry(repo_id, 0, 0, 0, 0, 0, False, error)
+
+def local_size(local):
+    if isinstance(local, bytes):
+        return len(local)
+    return os.path.getsize(local)
+
+def format_bytes(num_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024 or unit == "GB":
+            break
+        num_bytes = num_bytes / 1024
+    return "%.1f %s" % (num_bytes, unit) if unit != "B" else "%d B" % num_bytes
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+def print_plan(entries, bandwidth_mbps):
+    """
+    Print the per repo files, bytes to transfer, and estimated upload time
+
+    Returns the number of repos which could not be planned, such as
+    those with missing artifacts
+    """
+    bytes_per_second = bandwidth_mbps * 1000 * 1000 / 8
+    print("%-40s %11s %12s %12s %9s" % ("repo", "files", "total", "to upload", "est time"))
+    for entry in entries:
+        if entry.error is not None:
+            print("%-40s ERROR: %s" % (entry.repo_id, entry.error))
+            continue
+        files = "%d/%d" % (entry.upload_files, entry.total_files)
+        if entry.deleted_files:
+            files = files + " -%d" % entry.deleted_files
+        note = "" if entry.known_remote else "  (no cached remote manifest)"
+        print("%-40s %11s %12s %12s %9s%s" % (entry.repo_id, files, format_bytes(entry.total_bytes),
+                                              format_bytes(entry.upload_bytes),
+                                              format_duration(entry.upload_bytes / bytes_per_second), note))
+    planned = [x for x in entries if x.error is None]
+    upload_bytes = sum(x.upload_bytes for x in planned)
+    print("Total: %d repos, %s to upload, about %s at %g Mbps" % (len(planned), format_bytes(upload_bytes),
+                                                                 format_duration(upload_bytes / bytes_per_second), bandwidth_mbps))
+    return len(entries) - len(planned)